@@ -6,88 +6,174 @@ Autor: Giovani Ortolani Barbosa
 import sys
 import os
 import requests
-from statistics import mean
-from statistics import pstdev
+from requests.adapters import HTTPAdapter
+from math import fsum, sqrt
 import time
+from collections import defaultdict, deque
 from datetime import datetime
 
-def getLogs(url, header):
+# orjson é opcional: se estiver instalado, é usado no lugar do parser json padrão
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# níveis de mensagem contabilizados por getErrorsStats e sua posição no contador de cada hora
+_LEVELS = {"ERROR": 0, "CRITICAL": 1}
+
+# sessão reaproveitada entre as requisições, mantendo a conexão aberta (keep-alive)
+# e evitando um novo handshake TCP/TLS a cada minuto
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+SESSION.headers.update({"Accept-Encoding": "gzip"})
+
+def getLogs(url, since=None):
     '''
-    Faz uma requisição de logs para a url
+    Faz uma requisição de logs para a url usando a sessão persistente
 
     Args:
         url: string com a url do site;
-        header: dicionário com as informações do header da requisição (auth token, nesse caso);
+        since: timestamp (unix epoch time em ms) do log mais recente já recebido; se informado,
+               é enviado como parâmetro "since" para que a api retorne somente logs novos;
     Retorno:
         logs: logs no formato JSON;
     '''
 
+    params = {"since": since} if since is not None else None
+
     try:
-        r = requests.get(url, headers=header)
-        return r.json() 
-    except requests.exceptions.RequestException as err:
+        r = SESSION.get(url, params=params, timeout=10)
+        if orjson is not None:
+            return orjson.loads(r.content)
+        return r.json()
+    # ValueError cobre respostas que não são JSON válido, tanto no orjson quanto no json padrão
+    except (requests.exceptions.RequestException, ValueError) as err:
         print(err)
         sys.exit(1) 
 
+def filterNewLogs(logs, seenLogs):
+    '''
+    Remove os logs que já foram processados em requisições anteriores, já que a api
+    pode retornar novamente logs antigos
+
+    Args:
+        logs: logs da requisição atual no formato JSON;
+        seenLogs: tupla (set, deque) com as chaves dos logs já processados; o deque guarda
+                  a ordem de inserção e limita a memória usada (maxlen);
+    Retorno:
+        newLogs: lista somente com os logs ainda não processados;
+        seenLogs: tupla (set, deque) atualizada com as chaves dos logs atuais;
+    '''
+
+    seenKeys, seenOrder = seenLogs
+    newLogs = []
+    # chaves dos logs novos desta requisição
+    newKeys = []
+
+    for log in logs:
+        # identifica o log pelo horário, projeto, nível, mensagem e duração
+        key = hash((log["timestamp"], log["project"], log.get("level"), log.get("message", ""),
+                    log.get("request_duration")))
+        # compara somente com os logs de requisições anteriores, para que logs
+        # idênticos dentro da mesma requisição continuem sendo contabilizados
+        if key in seenKeys:
+            continue
+        newKeys.append(key)
+        newLogs.append(log)
+
+    for key in newKeys:
+        # chave repetida dentro da mesma requisição, já foi inserida
+        if key in seenKeys:
+            continue
+        # caso o deque esteja cheio, esquece a chave mais antiga antes de inserir a nova
+        if len(seenOrder) == seenOrder.maxlen:
+            seenKeys.discard(seenOrder[0])
+        seenOrder.append(key)
+        seenKeys.add(key)
+
+    return newLogs, seenLogs
+
 def getTracebacks(logs, lastTBacks):
     '''
     Recupera os últimos 5 tracebacks
 
     Args:
         logs: logs da requisição atual no formato JSON;
-        lastTBacks: lista com os últimos tracebacks das requisições anteriores;
+        lastTBacks: deque (maxlen=5) com os últimos tracebacks das requisições anteriores,
+                    do mais recente para o mais antigo;
     Retorno:
-        lastTBacks: lista atualizada contando os tracebacks da requisição atual;
+        lastTBacks: deque atualizado contando os tracebacks da requisição atual;
     '''
 
     # lista com as últimas tracebacks da última requisição
     localTBacks = []
-    # limita a lista de tracebacks a 5 entradas
-    numTraceBacks = 5
+    # limita a lista de tracebacks ao tamanho máximo do deque (5 entradas)
+    numTraceBacks = lastTBacks.maxlen
 
     # começa a partir do fim da lista de logs, já que estão ordenados por timestamp (aparentemente)
     for log in reversed(logs):
-        # somente adiciona na lista de tbacks se for uma tback e se a lista não estiver cheia
-        if "traceback" in log and len(localTBacks) < numTraceBacks:
+        # somente adiciona na lista de tbacks se for uma tback
+        if "traceback" in log:
             localTBacks.append(log)
+            # para a busca assim que a lista estiver cheia
+            if len(localTBacks) >= numTraceBacks:
+                break
     
-    # concatena as novas tbacks com as tbacks de requisições anteriores
-    lastTBacks = localTBacks + lastTBacks
-    # caso passe do tamanho desejado, elimina as tbacks mais antigas
-    if(len(lastTBacks) > numTraceBacks):
-        lastTBacks = lastTBacks[:numTraceBacks]
+    # insere as novas tbacks no início do deque, da mais antiga para a mais recente;
+    # o deque elimina automaticamente as tbacks mais antigas ao passar do tamanho máximo
+    lastTBacks.extendleft(reversed(localTBacks))
 
     return lastTBacks 
 
-def calculateStatistics(logs, reqDurList):
+def calculateStatistics(logs, reqDurStats):
     '''
     Calcula a média e desvio-padrão do tempo de resposta das requisições que possuem os
-    campos "responde_code" e "request_duration"
+    campos "response_code" e "request_duration", de forma incremental: as estatísticas das
+    requisições atuais são calculadas em lote e combinadas com as acumuladas
 
     Args:
         logs: logs da requisição atual no formato JSON;
-        reqDurList: lista com as durações de todas as requisições passadas;
+        reqDurStats: tupla (n, média, M2) acumulada com as durações das requisições passadas;
     Retorno:
         reqDurMean: média do tempo da duração de todas as requisições (passadas + atuais);
         reqDurStdev: desvio-padrão do tempo da duração de todas as requisições (passadas + atuais);
-        reqDurList: lista com as durações das requisições passadas + atuais;
+        reqDurStats: tupla (n, média, M2) atualizada com as durações das requisições atuais;
     '''
 
+    n, reqDurMean, m2 = reqDurStats
+
+    # durações das requisições atuais
+    durs = []
     for log in logs:
-        # log é uma requisição
-        if "response_code" and "request_duration" in log:
+        # log é uma requisição somente se possuir ambos os campos
+        dur = log.get("request_duration")
+        if dur is not None and "response_code" in log:
             # armazena na lista de requisições
-            reqDurList.append(log["request_duration"])
+            durs.append(dur)
+
+    if durs:
+        # média e soma dos quadrados das diferenças (M2) somente das requisições atuais
+        nBatch = len(durs)
+        meanBatch = fsum(durs) / nBatch
+        m2Batch = fsum([(d - meanBatch) ** 2 for d in durs])
 
-    # se o request trouxe logs que são requisições, então calcula
+        # combina com os valores acumulados das requisições passadas (fórmula de Chan)
+        nTotal = n + nBatch
+        delta = meanBatch - reqDurMean
+        reqDurMean += delta * nBatch / nTotal
+        m2 += m2Batch + delta * delta * n * nBatch / nTotal
+        n = nTotal
+
+    reqDurStats = (n, reqDurMean, m2)
+
+    # se algum request trouxe logs que são requisições, então calcula
     # senão, não faz nada
-    if reqDurList:
-        reqDurMean = mean(reqDurList)
-        reqDurStdev = pstdev(reqDurList)
+    if n:
+        reqDurStdev = sqrt(m2 / n)
     else:
         reqDurMean, reqDurStdev = None, None
 
-    return reqDurMean, reqDurStdev, reqDurList
+    return reqDurMean, reqDurStdev, reqDurStats
     
 def getErrorsStats(logs, errorStats):
     '''
@@ -96,137 +182,201 @@ def getErrorsStats(logs, errorStats):
 
     Args:
         logs: logs da requisição atual no formato JSON;
-        errorStats: dicionário cujas chaves são o nome dos projetos e chave possui
-                    outro dicionário cujas chaves são os horários;
+        errorStats: defaultdict cujas chaves são o nome dos projetos e cada chave possui uma
+                    lista de 24 posições (uma por hora) com os contadores [ERROR, CRITICAL];
                     Ex: {
-                            'meed_fanager': {'18': {'CRITICAL': 2, 'ERROR': 0}, '19': {'CRITICAL': 2, 'ERROR': 0}},
-                            'dyonisius': {'18': {'CRITICAL': 2, 'ERROR': 0}, '19': {'CRITICAL': 2, 'ERROR': 0}}
+                            'meed_fanager': [[0, 0], ..., [0, 2], [0, 2], ..., [0, 0]],
+                            'dyonisius': [[0, 0], ..., [1, 0], [0, 2], ..., [0, 0]]
                         }
     Retorno:
         errorStats: mesmo dicionário de entrada, atualizado com os dados do novo request;
     '''
 
+    # deslocamento do fuso horário local em segundos e a hora UTC a que ele se refere; como o
+    # horário de verão pode mudar o deslocamento, ele é recalculado a cada nova hora UTC
+    tzOffset, lastUtcHour = 0, None
+
+    # contador do último par (projeto, horário) acessado; como os logs estão ordenados por
+    # timestamp, logs consecutivos costumam cair no mesmo contador
+    lastProject, lastHour, bucket = None, None, None
+
     for log in logs:
-        # extrai o horário do timestamp em formato unix epoch time
-        hour = time.strftime("%H", time.localtime(log["timestamp"]/1000.))
-        # se projeto não está no dict, adiciona ele e o horário
-        # senão, verifica se o horário já faz parte do projeto e adiciona caso não faça parte
-        if log["project"] not in errorStats:
-            errorStats[log["project"]] = {hour: {"ERROR": 0, "CRITICAL": 0}}
-        elif hour not in errorStats[log["project"]]:
-            errorStats[log["project"]][hour] = {"ERROR": 0, "CRITICAL": 0}
-
-        # incrementa o número de erros ou criticals dependendo do "level" da mensagem
-        if log["level"] == "ERROR" or log["level"] == "CRITICAL":
-            errorStats[log["project"]][hour][log["level"]] += 1
+        levelId = _LEVELS.get(log["level"])
+        # somente mensagens ERROR ou CRITICAL são contabilizadas
+        if levelId is not None:
+            project = log["project"]
+            timestamp = int(log["timestamp"])
+            # os logs estão ordenados por timestamp, então localtime é chamado uma vez por hora
+            utcHour = timestamp // 3600000
+            if utcHour != lastUtcHour:
+                tzOffset = time.localtime(timestamp / 1000.).tm_gmtoff
+                lastUtcHour = utcHour
+            # extrai a hora local (0 a 23) do timestamp em formato unix epoch time (ms)
+            hour = ((timestamp // 1000 + tzOffset) // 3600) % 24
+            # só busca o contador no dicionário quando o projeto ou o horário mudam;
+            # projetos ausentes são criados automaticamente pelo defaultdict
+            if project != lastProject or hour != lastHour:
+                bucket = errorStats[project][hour]
+                lastProject, lastHour = project, hour
+            bucket[levelId] += 1
     
     return errorStats
 
-def printTBacks(lastTBacks):
+def printTBacks(lastTBacks, buf):
     '''
-    Imprime em formato amigável informações sobre os últimos 5 tracebacks
+    Adiciona ao buffer do relatório, em formato amigável, informações sobre os últimos
+    5 tracebacks
 
     Args:
-        lastTbacks: lista com os últimos tracebacks das requisições anteriores;
+        lastTbacks: deque com os últimos tracebacks das requisições anteriores;
+        buf: lista de strings onde o relatório é acumulado; run a imprime de uma só vez;
     '''
 
     i = 1
-    print("### Últimos 5 tracebacks ###")
+    buf.append("### Últimos 5 tracebacks ###\n")
     for log in lastTBacks:
-        print("({})".format(i))
-        print("Projeto:\n  {}".format(log["project"]))
-        print("Mensagem:\n  {}".format(log["message"]))
-        print("{}\n".format(log["traceback"]))
+        buf.append("({})\n".format(i))
+        buf.append("Projeto:\n  {}\n".format(log["project"]))
+        buf.append("Mensagem:\n  {}\n".format(log["message"]))
+        buf.append("{}\n\n".format(log["traceback"]))
         i += 1
     
     if not lastTBacks:
-        print("   Sem tracebacks nas últimas requisições\n")
+        buf.append("   Sem tracebacks nas últimas requisições\n\n")
 
-def printStatistics(mean, stdev):
+def printStatistics(mean, stdev, buf):
     '''
-    Imprime em formato amigável informações sobre a média e desvio-padrão do tempo 
-    das requisições
+    Adiciona ao buffer do relatório, em formato amigável, informações sobre a média e
+    desvio-padrão do tempo das requisições
 
     Args:
         mean: valor da média float;
         stdev: valor do desvio-padrão float;
+        buf: lista de strings onde o relatório é acumulado; run a imprime de uma só vez;
     '''
 
-    print("### Estatísticas das requisições ###")
-    print("  Média:\n    {}".format(mean))
-    print("  Desvio padrão:\n    {}".format(stdev))
-    print()
+    buf.append("### Estatísticas das requisições ###\n")
+    buf.append("  Média:\n    {}\n".format(mean))
+    buf.append("  Desvio padrão:\n    {}\n".format(stdev))
+    buf.append("\n")
 
-def printErrorsStats(errorStats):
+def printErrorsStats(errorStats, buf):
     '''
-    Imprime em formato amigável informações sobre o número de mensagens com o atributo
-    "level" sendo ERROR ou CRITICAL por projeto, agrupados por hora
+    Adiciona ao buffer do relatório, em formato amigável, informações sobre o número de
+    mensagens com o atributo "level" sendo ERROR ou CRITICAL por projeto, agrupados por hora
 
     Args:
-        errorStats: dicionário cujas chaves são o nome dos projetos e chave possui
-                    outro dicionário cujas chaves são os horários;
+        errorStats: defaultdict cujas chaves são o nome dos projetos e cada chave possui uma
+                    lista de 24 posições (uma por hora) com os contadores [ERROR, CRITICAL];
                     Ex: {
-                            'meed_fanager': {'18': {'CRITICAL': 2, 'ERROR': 0}, '19': {'CRITICAL': 2, 'ERROR': 0}},
-                            'dyonisius': {'18': {'CRITICAL': 2, 'ERROR': 0}, '19': {'CRITICAL': 2, 'ERROR': 0}}
+                            'meed_fanager': [[0, 0], ..., [0, 2], [0, 2], ..., [0, 0]],
+                            'dyonisius': [[0, 0], ..., [1, 0], [0, 2], ..., [0, 0]]
                         }
+        buf: lista de strings onde o relatório é acumulado; run a imprime de uma só vez;
     '''
 
-    print("### Número de ERRORS e CRITICALS por projeto ###")
+    buf.append("### Número de ERRORS e CRITICALS por projeto ###\n")
     for proj, hours in errorStats.items():
-        print("  Projeto:\n    {}".format(proj))
-        # ordena as chaves do dicionário de horas para poder imprimir em ordem cronológica
-        hoursSorted = sorted(hours)
-        for hour in hoursSorted:
-            print("    ({}h) ERROR: {}, CRITICAL: {}".format(hour, hours[hour]["CRITICAL"], hours[hour]["ERROR"]))
+        buf.append("  Projeto:\n    {}\n".format(proj))
+        # as horas já estão em ordem cronológica; ignora as horas sem mensagens
+        for hour in range(24):
+            errors, criticals = hours[hour]
+            if errors or criticals:
+                buf.append("    ({:02d}h) ERROR: {}, CRITICAL: {}\n".format(hour, errors, criticals))
 
-    print()
+    buf.append("\n")
 
-def run(url, header, lastTBacks, lastReqDurs, errorStats):
+def run(url, lastTBacks, lastReqDurs, errorStats, seenLogs, lastTimestamp, useSince):
     '''
     Faz a requisição dos logs, extrai métricas como tracebacks, estatísticas dos tempos das 
     requisições, número de mensagens de erros e imprime-as
 
     Args: 
         url: string com a url do site;
-        header: dicionário com as informações do header da requisição (auth token, nesse caso);
-        lastTbacks: lista com os últimos tracebacks das requisições anteriores;
-        lastReqDurs: lista com as durações de todas as requisições passadas;
-        errorStats: dicionário cujas chaves são o nome dos projetos e chave possui
-                    outro dicionário cujas chaves são os horários;
+        lastTbacks: deque com os últimos tracebacks das requisições anteriores;
+        lastReqDurs: tupla (n, média, M2) acumulada com as durações das requisições passadas;
+        errorStats: defaultdict cujas chaves são o nome dos projetos e cada chave possui uma
+                    lista de 24 posições (uma por hora) com os contadores [ERROR, CRITICAL];
                     Ex: {
-                            'meed_fanager': {'18': {'CRITICAL': 2, 'ERROR': 0}, '19': {'CRITICAL': 2, 'ERROR': 0}},
-                            'dyonisius': {'18': {'CRITICAL': 2, 'ERROR': 0}, '19': {'CRITICAL': 2, 'ERROR': 0}}
+                            'meed_fanager': [[0, 0], ..., [0, 2], [0, 2], ..., [0, 0]],
+                            'dyonisius': [[0, 0], ..., [1, 0], [0, 2], ..., [0, 0]]
                         }
+        seenLogs: tupla (set, deque) com as chaves dos logs já processados;
+        lastTimestamp: timestamp do log mais recente recebido até agora (None na primeira vez);
+        useSince: se True, envia lastTimestamp no parâmetro "since" da requisição; é desligado
+                  quando a resposta indica que a api não trata o parâmetro como esperado;
     '''
 
-    logs = getLogs(url, header)
+    sentSince = useSince and lastTimestamp is not None
+    logs = getLogs(url, lastTimestamp if sentSince else None)
+
+    # resposta inesperada (ex: objeto de erro): não usa mais o "since" e tenta de novo no próximo minuto
+    if not isinstance(logs, list):
+        useSince = False
+        sys.stdout.write(datetime.now().strftime("%d-%m-%Y %H:%M:%S - resposta inesperada da api: "))
+        sys.stdout.write("{}\n".format(logs))
+        sys.stdout.flush()
+        return lastTBacks, lastReqDurs, errorStats, seenLogs, lastTimestamp, useSince
+
+    # guarda o timestamp mais recente para pedir somente logs novos na próxima requisição
+    newestTimestamp = max((log["timestamp"] for log in logs), default=None)
+    # se a resposta não trouxe nenhum log mais novo que o "since" enviado, não dá para saber se a
+    # api interpreta o parâmetro corretamente; volta a pedir todos os logs (filterNewLogs descarta
+    # os repetidos)
+    if sentSince and (newestTimestamp is None or newestTimestamp <= lastTimestamp):
+        useSince = False
+    if newestTimestamp is not None and (lastTimestamp is None or newestTimestamp > lastTimestamp):
+        lastTimestamp = newestTimestamp
+    # descarta os logs já processados em requisições anteriores
+    logs, seenLogs = filterNewLogs(logs, seenLogs)
+
+    # sem logs novos as métricas não mudam, então não refaz os cálculos nem reimprime o relatório
+    if not logs:
+        sys.stdout.write(datetime.now().strftime("%d-%m-%Y %H:%M:%S - sem logs novos\n"))
+        sys.stdout.flush()
+        return lastTBacks, lastReqDurs, errorStats, seenLogs, lastTimestamp, useSince
+
     errorStats = getErrorsStats(logs, errorStats)
     lastTBacks = getTracebacks(logs, lastTBacks)
     mean, stdev, lastReqDurs = calculateStatistics(logs, lastReqDurs)
 
-    print("--------------------------------------------------------------------------------")
-    print(datetime.now().strftime("\n%d-%m-%Y %H:%M:%S\n"))
+    # acumula todo o relatório e imprime de uma só vez
+    buf = []
+    buf.append("--------------------------------------------------------------------------------\n")
+    buf.append(datetime.now().strftime("\n%d-%m-%Y %H:%M:%S\n\n"))
     #_ = os.system('cls' if os.name == 'nt' else 'clear') # limpa a tela
-    printErrorsStats(errorStats)
-    printTBacks(lastTBacks)
-    printStatistics(mean, stdev)
-    print("--------------------------------------------------------------------------------")
+    printErrorsStats(errorStats, buf)
+    printTBacks(lastTBacks, buf)
+    printStatistics(mean, stdev, buf)
+    buf.append("--------------------------------------------------------------------------------\n")
+    sys.stdout.write("".join(buf))
+    sys.stdout.flush()
     
-    return lastTBacks, lastReqDurs, errorStats
+    return lastTBacks, lastReqDurs, errorStats, seenLogs, lastTimestamp, useSince
 
 if __name__ == '__main__':
     # getLogs
     url = "https://psel-logs.raccoon.ag/api/v2/logs"
     header = {"authorization": "2747e5610e9c4262836c5ececc5b5ed4"}
+    SESSION.headers.update(header)
+    lastTimestamp = None
+    # o parâmetro "since" só deve ser habilitado se a api suportá-lo (timestamp em ms, logs
+    # com timestamp maior ou igual); por padrão todos os logs são pedidos a cada requisição
+    useSince = False
     # getTracebacks
-    lastTBacks = []
+    lastTBacks = deque(maxlen=5)
     # calculateStatistics
-    lastReqDurs = []
+    lastReqDurs = (0, 0.0, 0.0)
     # getErrorsStats
-    errorStats = {}
+    errorStats = defaultdict(lambda: [[0, 0] for _ in range(24)])
+    # filterNewLogs
+    seenLogs = (set(), deque(maxlen=100000))
 
-    # garante a execução a cada 1 minuto exatamente
-    starttime = time.time()
+    # garante a execução a cada 1 minuto exatamente; usa o relógio monotônico para não ser
+    # afetado por ajustes no horário do sistema
+    nextWake = time.monotonic()
     while True:
-        lastTBacks, lastReqDurs, errorStats = run(url, header, lastTBacks, lastReqDurs, errorStats)
-        time.sleep(60.0 - ((time.time() - starttime) % 60.0))
\ No newline at end of file
+        lastTBacks, lastReqDurs, errorStats, seenLogs, lastTimestamp, useSince = run(
+            url, lastTBacks, lastReqDurs, errorStats, seenLogs, lastTimestamp, useSince)
+        nextWake += 60.0
+        time.sleep(max(0.0, nextWake - time.monotonic()))
\ No newline at end of file